@@ -2,21 +2,25 @@
 
 import argparse
 import base64
-from functools import partial, wraps
+from functools import wraps
+import hmac
 from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
 try:
-	# New in version 3.7
-	from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+	# optional C-accelerated encoder/decoder, falls back to the standard library
+	import orjson
+	_dumps = orjson.dumps
+	_loads = orjson.loads
 except ImportError:
-	from http.server import BaseHTTPRequestHandler, HTTPServer
-	import socketserver
-	class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
-		daemon_thread = True
-import json
+	def _dumps(obj):
+		return json.dumps(obj).encode("utf-8")
+	_loads = json.loads
 import logging
-import re
+import math
+import queue
 import ssl
-import traceback
+from threading import Lock, Thread
 
 from urllib.parse import unquote
 
@@ -24,12 +28,40 @@ from lock_manager import LockManager, LockManagerRepeatedAcquire, LockManagerNot
 
 logger = logging.getLogger(__name__)
 
+# largest PUT/PATCH body accepted, request payloads are only a few small fields
+_MAX_BODY = 65536
+
+_EXCLUSIVE_NAME = "exclusive"
+_SHARED_NAME = "shared"
+# lock type names indexed by LockManager.LOCK_EXCLUSIVE/LOCK_SHARED value
+_LOCK_NAME = (None, _EXCLUSIVE_NAME, _SHARED_NAME)
+
+def _valid_priority(priority):
+	# finite numbers only, NaN would break the ordering of the request queue
+	return isinstance(priority, (int, float)) and not isinstance(priority, bool) and math.isfinite(priority)
+
+def _lock_fmt(x):
+	return {
+		"priority": x.priority,
+		"client": x.client,
+		"lock_type": x.lock_type,
+		"request_timestamp": x.request_timestamp.isoformat()
+	}
+
+def _holder_fmt(x):
+	return {
+		"lock_type": _LOCK_NAME[x.lock_type],
+		"client": x.client,
+		"acquire_timestamp": x.acquire_timestamp.isoformat()
+	}
+
 def main():
 	parser = argparse.ArgumentParser()
-	parser.add_argument("-i", "--interval", default=1)
+	parser.add_argument("-i", "--interval", required=False, help="deprecated and ignored")
 	parser.add_argument("-p", "--port", default=8000)
 	parser.add_argument("-a", "--authentication", required=False, metavar="username:password")
 	parser.add_argument("-c", "--certificate", required=False)
+	parser.add_argument("-w", "--workers", type=int, default=32, help="number of pooled request handling threads")
 	args = parser.parse_args()
 	
 	loglevels = [logging.INFO, logging.DEBUG]
@@ -38,167 +70,245 @@ def main():
 	logging.getLogger().addHandler(console_handler)
 	logging.getLogger().setLevel(verboselevel)
 	
-	lockman = LockManager(args.interval)
-	lockman_handler = partial(LockHttpHandler, lockman, args.authentication)
-	httpd = ThreadingHTTPServer(("", args.port), lockman_handler)
+	if args.interval is not None:
+		logger.warning("-i/--interval is deprecated and ignored")
+	lockman = LockManager()
+	httpd = PooledHTTPServer(("", args.port), LockHttpHandler, workers=args.workers)
+	httpd.lockmanager = lockman
+	httpd.expected_authorization = basic_authorization(args.authentication)
 	if args.certificate:
 		ssl.wrap_socket(httpd, certfile=args.certificate, server_side=True)
 	httpd.serve_forever()
 
-class LockHttpHandler(BaseHTTPRequestHandler):
-	DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
-	LOCKS_ENDPOINT = r"^/locks"
-	HOLDERS_ENDPOINT = r"^/holders"
-	LOCK_TYPE_MAP = {"exclusive": LockManager.LOCK_EXCLUSIVE, "shared": LockManager.LOCK_SHARED}
+def basic_authorization(authentication):
+	"""
+	The exact Authorization header expected for <authentication> of the form username:password, or None if not set
+	Handlers compare request headers against this as is instead of decoding each one
+	"""
+	if not authentication:
+		return None
+	return b"Basic " + base64.b64encode(authentication.encode("utf-8"))
+
+class PooledHTTPServer(HTTPServer):
+	"""
+	HTTPServer handling requests on a pool of reused daemon worker threads rather than a new thread per connection
+	A request waiting on a lock occupies its worker, so when every worker is busy a connection gets its own thread
+	instead of queueing behind the waiters (e.g. the release that would let them through)
+	"""
+	def __init__(self, *args, workers=32, **kwargs):
+		super(PooledHTTPServer, self).__init__(*args, **kwargs)
+		self.requests = queue.Queue()
+		# workers waiting on <requests> that have not yet been handed a request
+		self.idle_workers = 0
+		self.idle_mutex = Lock()
+		self.workers = [Thread(target=self.worker, daemon=True) for _ in range(workers)]
+		for t in self.workers:
+			t.start()
+	
+	def process_request(self, request, client_address):
+		with self.idle_mutex:
+			if self.idle_workers:
+				self.idle_workers -= 1
+				self.requests.put((request, client_address))
+				return
+		Thread(target=self.process_request_thread, args=(request, client_address), daemon=True).start()
 	
-	lockmanager = None
+	def worker(self):
+		while True:
+			with self.idle_mutex:
+				self.idle_workers += 1
+			item = self.requests.get()
+			if item is None:
+				return
+			self.process_request_thread(*item)
 	
-	def __init__(self, lockmanager, authentication, *args, **kwargs):
-		type(self).lockmanager = lockmanager
-		self.authentication = authentication
-		super(LockHttpHandler, self).__init__(*args, **kwargs)
+	def process_request_thread(self, request, client_address):
+		# same as socketserver.ThreadingMixIn.process_request_thread
+		try:
+			self.finish_request(request, client_address)
+		except Exception:
+			self.handle_error(request, client_address)
+		finally:
+			self.shutdown_request(request)
+	
+	def server_close(self):
+		super(PooledHTTPServer, self).server_close()
+		# idle workers exit, busy ones are daemon threads and do not hold up interpreter exit
+		for _ in self.workers:
+			self.requests.put(None)
+
+class LockHttpHandler(BaseHTTPRequestHandler):
+	DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+	LOCK_TYPE_MAP = {_EXCLUSIVE_NAME: LockManager.LOCK_EXCLUSIVE, _SHARED_NAME: LockManager.LOCK_SHARED}
+	# buffer the response so the status line, headers (already gathered by send_header) and body
+	# leave in a single write when handle_one_request flushes, instead of one unbuffered write each
+	wbufsize = -1
+	# socket timeout in seconds so an idle or stalled connection cannot hold a thread indefinitely,
+	# this does not limit how long a PUT may wait for a lock
+	timeout = 60
 	
 	def _http_wrap(func):
 		@wraps(func)
 		def wrapper(self, *args, **kwargs):
 			try:
-				if self.authentication:
-					authorization = self.headers.get("Authorization")
-					auth_decode = base64.b64decode(authorization[len("Basic "):]).decode("utf-8") if authorization else None
-					if not auth_decode:
-						self.send_response(HTTPStatus.UNAUTHORIZED.value)
-						self.send_header("WWW-Authenticate", 'Basic, charset="UTF-8"')
-						self.end_headers()
+				expected_authorization = self.server.expected_authorization
+				if expected_authorization and not hmac.compare_digest(self.headers.get("Authorization", "").encode("utf-8"), expected_authorization):
+					self.send_response(HTTPStatus.UNAUTHORIZED.value)
+					self.send_header("WWW-Authenticate", 'Basic, charset="UTF-8"')
+					self.end_headers()
+					return
 				
 				if not func(self, *args, **kwargs):
 					self.send_response(HTTPStatus.NOT_FOUND.value)
 					self.end_headers()
 			except LockManagerRepeatedAcquire as e:
-				self.send_body(HTTPStatus.CONFLICT.value, json.dumps({"message": str(e)}))
+				self.send_body(HTTPStatus.CONFLICT.value, _dumps({"message": str(e)}))
 			except LockManagerNotFound as e:
-				self.send_body(HTTPStatus.NOT_FOUND.value, json.dumps({"message": str(e)}))
+				self.send_body(HTTPStatus.NOT_FOUND.value, _dumps({"message": str(e)}))
 			except LockManagerTimeout as e:
-				self.send_body(HTTPStatus.REQUEST_TIMEOUT.value, json.dumps({"message": str(e)}))
-			except:
-				logger.error(traceback.format_exc())
+				self.send_body(HTTPStatus.REQUEST_TIMEOUT.value, _dumps({"message": str(e)}))
+			except Exception:
+				logger.exception("error handling %s %s", self.command, self.path)
 				self.send_response(HTTPStatus.INTERNAL_SERVER_ERROR.value)
 				self.end_headers()
 		return wrapper
 
 	@_http_wrap
-	def do_GET(self):
-		locks, holders = type(self).lockmanager.get_state()
-		
-		lock_fmt = lambda x: {
-			"priority": x.priority,
-			"client": x.client,
-			"lock_type": x.lock_type,
-			"request_timestamp": x.request_timestamp.isoformat()
-		}
-		holder_fmt = lambda x: {
-			"lock_type": {v: k for k, v in type(self).LOCK_TYPE_MAP.items()}.get(x.lock_type),
-			"client": x.client,
-			"acquire_timestamp": x.acquire_timestamp.isoformat()
-		}
+	def _route(self):
+		# a single trailing slash is optional, the path is first tried without it and then with it as an
+		# empty last segment, matching the "/?$" regexes this router replaced
+		paths = (self.path[:-1], self.path) if self.path.endswith("/") else (self.path,)
+		for path in paths:
+			parts = path.split("/")
+			if len(parts) < 2 or parts[0]:
+				continue
+			handler = self.ROUTES.get((self.command, len(parts), parts[1]))
+			if handler is not None:
+				return handler(self, *[unquote(x) for x in parts[2:]])
+		return False
+	
+	do_GET = do_PUT = do_DELETE = do_PATCH = _route
+	
+	def _get_locks_all(self):
+		# population of all locks
+		locks = self.server.lockmanager.get_locks()
+		self.send_json_mapping(HTTPStatus.OK.value, locks, _lock_fmt)
+		return True
+	
+	def _get_locks_one(self, lockname):
+		# details for single lock
+		lock = self.server.lockmanager.get_lock(lockname)
+		if lock is not None:
+			locks_serialized = [_lock_fmt(x) for x in lock]
+			self.send_body(HTTPStatus.OK.value, _dumps(locks_serialized))
+		else:
+			self.send_body(HTTPStatus.NOT_FOUND.value, "no lock of name [{0}] found".format(lockname))
+		return True
+	
+	def _get_holders_all(self):
+		# population of all actively held locks
+		holders = self.server.lockmanager.get_holders()
+		self.send_json_mapping(HTTPStatus.OK.value, holders, _holder_fmt)
+		return True
+	
+	def _get_holders_one(self, lockname):
+		# details for single actively held lock
+		holder = self.server.lockmanager.get_lock_holders(lockname)
+		if holder is not None:
+			holders_serialized = [_holder_fmt(x) for x in holder]
+			self.send_body(HTTPStatus.OK.value, _dumps(holders_serialized))
+		else:
+			self.send_body(HTTPStatus.NOT_FOUND.value, "no lock of name [{0}] found".format(lockname))
+		return True
+	
+	def _read_json_body(self):
+		"""
+		Read and parse the request body as a JSON object
+		Returns None after sending an error response if Content-Length is missing, invalid or too large, or the body is not a JSON object
+		"""
+		content_length = self.headers.get("Content-Length")
+		if content_length is None:
+			self.send_body(HTTPStatus.LENGTH_REQUIRED.value)
+			return None
+		try:
+			content_length = int(content_length)
+		except ValueError:
+			content_length = -1
+		if content_length < 0:
+			# a negative length would also make rfile.read block until the client closes the connection
+			self.send_body(HTTPStatus.BAD_REQUEST.value)
+			return None
+		if content_length > _MAX_BODY:
+			self.send_body(HTTPStatus.REQUEST_ENTITY_TOO_LARGE.value)
+			return None
 		
-		if re.search(self.LOCKS_ENDPOINT + r"/?$", self.path): # population of all locks
-			locks_serialized = {k: [lock_fmt(x) for x in v] for k, v in locks.items()}
-			self.send_body(HTTPStatus.OK.value, json.dumps(locks_serialized))
-			return True
-		m = re.search(self.LOCKS_ENDPOINT + r"/([^/]*)/?$", self.path) # details for single lock
-		if m:
-			lockname = unquote(m.group(1))
-			lock = locks.get(lockname)
-			if lock is not None:
-				locks_serialized = [lock_fmt(x) for x in lock]
-				self.send_body(HTTPStatus.OK.value, json.dumps(locks_serialized))
-			else:
-				self.send_body(HTTPStatus.NOT_FOUND.value, "no lock of name [{0}] found".format(lockname))
-			return True
-		if re.search(self.HOLDERS_ENDPOINT + r"/?$", self.path): # population of all actively held locks
-			holders_serialized = {k: [holder_fmt(x) for x in v] for k, v in holders.items()}
-			
-			self.send_body(HTTPStatus.OK.value, json.dumps(holders_serialized))
+		try:
+			jsonload = _loads(self.rfile.read(content_length))
+		except ValueError:
+			jsonload = None
+		if not isinstance(jsonload, dict):
+			self.send_body(HTTPStatus.BAD_REQUEST.value)
+			return None
+		return jsonload
+	
+	def _put_lock(self, lockname, client):
+		jsonload = self._read_json_body()
+		if jsonload is None:
 			return True
-		m = re.search(self.HOLDERS_ENDPOINT + r"/([^/]*)/?$", self.path) # details for single actively held lock
-		if m:
-			lockname = unquote(m.group(1))
-			holder = holders.get(lockname)
-			if holder is not None:
-				holders_serialized = [holder_fmt(x) for x in holder]
-				self.send_body(HTTPStatus.OK.value, json.dumps(holders_serialized))
-			else:
-				self.send_body(HTTPStatus.NOT_FOUND.value, "no lock of name [{0}] found".format(lockname))
+		priority = jsonload.get("priority")
+		timeout = jsonload.get("timeout", 10)
+		lock_typename = jsonload.get("type")
+		lock_type = type(self).LOCK_TYPE_MAP.get(lock_typename)
+		if not lockname or not client or not _valid_priority(priority) or not lock_type:
+			self.send_body(HTTPStatus.BAD_REQUEST.value)
 			return True
 		
-		return False
-	
-	@_http_wrap
-	def do_PUT(self):
-		content_length = int(self.headers["Content-Length"])
-		m = re.search(self.LOCKS_ENDPOINT + r"/([^/]*)/([^/]*)/?$", self.path)
-		if m:
-			lockname = unquote(m.group(1))
-			client = unquote(m.group(2))
-			payload = self.rfile.read(content_length)
-			jsonload = json.loads(payload)
-			priority = jsonload.get("priority")
-			timeout = jsonload.get("timeout", 10)
-			lock_typename = jsonload.get("type")
-			lock_type = type(self).LOCK_TYPE_MAP.get(lock_typename)
-			if not lockname or not client or priority is None or not lock_type:
-				self.send_body(HTTPStatus.BAD_REQUEST.value)
-				return True
-			
-			try:
-				lockrequest = type(self).lockmanager.acquire(lockname, client, priority=priority, timeout=timeout, lock_type=lock_type)
-				self.send_body(HTTPStatus.CREATED.value, json.dumps({"message": "lock [{0}] of type [{1}] acquired by client [{2}] with priority [{3}]".format(lockname, lock_typename, client, lockrequest.priority)}))
-			except LockManagerRepeatedAcquire:
-				# treat locks as re-entrant (idempotent PUT)
-				self.send_body(HTTPStatus.OK.value, json.dumps({"message": "NOOP - lock [{0}] has already been acquried by client [{1}]".format(lockname, client)}))
-			
-			return True
+		try:
+			lockrequest = self.server.lockmanager.acquire(lockname, client, priority=priority, timeout=timeout, lock_type=lock_type)
+			self.send_body(HTTPStatus.CREATED.value, _dumps({"message": "lock [{0}] of type [{1}] acquired by client [{2}] with priority [{3}]".format(lockname, lock_typename, client, lockrequest.priority)}))
+		except LockManagerRepeatedAcquire:
+			# treat locks as re-entrant (idempotent PUT)
+			self.send_body(HTTPStatus.OK.value, _dumps({"message": "NOOP - lock [{0}] has already been acquried by client [{1}]".format(lockname, client)}))
+		except ValueError as e:
+			# e.g. a non-numeric timeout
+			self.send_body(HTTPStatus.BAD_REQUEST.value, _dumps({"message": str(e)}))
 		
-		return False
+		return True
 	
-	@_http_wrap
-	def do_DELETE(self):
-		m = re.search(self.LOCKS_ENDPOINT + r"/([^/]*)/([^/]*)/?$", self.path)
-		if m:
-			lockname = unquote(m.group(1))
-			client = unquote(m.group(2))
-			if not lockname or not client:
-				self.send_body(HTTPStatus.BAD_REQUEST.value)
-				return True
-			
-			type(self).lockmanager.release(lockname, client)
-			self.send_body(HTTPStatus.OK.value, json.dumps({"message": "[{0}] released by [{1}]".format(lockname, client)}))
-			
+	def _delete_lock(self, lockname, client):
+		if not lockname or not client:
+			self.send_body(HTTPStatus.BAD_REQUEST.value)
 			return True
 		
-		return False
-
-	@_http_wrap
-	def do_PATCH(self):
-		content_length = int(self.headers["Content-Length"])
+		self.server.lockmanager.release(lockname, client)
+		self.send_body(HTTPStatus.OK.value, _dumps({"message": "[{0}] released by [{1}]".format(lockname, client)}))
 		
-		m = re.search(self.LOCKS_ENDPOINT + r"/([^/]*)/([^/]*)/?$", self.path)
-		if m:
-			lockname = unquote(m.group(1))
-			client = unquote(m.group(2))
-			payload = self.rfile.read(content_length)
-			jsonload = json.loads(payload)
-			priority = jsonload.get("priority")
-			if not lockname or not client or priority is None:
-				self.send_body(HTTPStatus.BAD_REQUEST.value)
-				return True
-			
-			old_priority = type(self).lockmanager.modify_priority(lockname, client, priority)
-			self.send_body(HTTPStatus.OK.value, json.dumps({"old_priority": old_priority, "message": "[{0}] changed priority on [{1}] from {2} to {3}".format(client, lockname, old_priority, priority)}))
-			
+		return True
+	
+	def _patch_lock(self, lockname, client):
+		jsonload = self._read_json_body()
+		if jsonload is None:
+			return True
+		priority = jsonload.get("priority")
+		if not lockname or not client or not _valid_priority(priority):
+			self.send_body(HTTPStatus.BAD_REQUEST.value)
 			return True
 		
-		return False
+		old_priority = self.server.lockmanager.modify_priority(lockname, client, priority)
+		self.send_body(HTTPStatus.OK.value, _dumps({"old_priority": old_priority, "message": "[{0}] changed priority on [{1}] from {2} to {3}".format(client, lockname, old_priority, priority)}))
+		
+		return True
+	
+	# (method, path segment count, first path segment) -> handler
+	ROUTES = {
+		("GET", 2, "locks"): _get_locks_all,
+		("GET", 3, "locks"): _get_locks_one,
+		("GET", 2, "holders"): _get_holders_all,
+		("GET", 3, "holders"): _get_holders_one,
+		("PUT", 4, "locks"): _put_lock,
+		("DELETE", 4, "locks"): _delete_lock,
+		("PATCH", 4, "locks"): _patch_lock,
+	}
 	
 	def send_body(self, status, body=None, headers=None):
 		if headers is None:
@@ -209,7 +319,30 @@ class LockHttpHandler(BaseHTTPRequestHandler):
 			self.send_header(k, v)
 		self.end_headers()
 		if body:
-			self.wfile.write(bytes(body, "utf-8"))
+			self.wfile.write(body if isinstance(body, bytes) else bytes(body, "utf-8"))
+	
+	def send_json_mapping(self, status, mapping, fmt):
+		"""
+		Send <mapping> of name -> entries as a JSON object with each entry formatted by <fmt>
+		The object is encoded and written one name at a time rather than building the whole response first
+		"""
+		self.send_response(status)
+		self.send_header("Content-Type", "application/json")
+		self.end_headers()
+		
+		write = self.wfile.write
+		write(b"{")
+		try:
+			for i, (name, entries) in enumerate(mapping.items()):
+				# encode the whole member before writing any of it
+				write((b"," if i else b"") + _dumps(name) + b":" + _dumps([fmt(x) for x in entries]))
+		except Exception:
+			# the status line is already out so an error status cannot follow, leave the body truncated
+			# (invalid JSON) and drop the connection instead
+			logger.exception("error streaming %s %s", self.command, self.path)
+			self.close_connection = True
+			return
+		write(b"}")
 
 if __name__ == "__main__":
 	main()
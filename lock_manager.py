@@ -1,9 +1,12 @@
 import bisect
 from collections import namedtuple
 from datetime import datetime
-import itertools
-from threading import Lock
+from threading import Condition, Lock, TIMEOUT_MAX
 import time
+import warnings
+
+# local timezone resolved once at import rather than per lock operation (a fixed UTC offset, DST changes are not followed)
+_LOCAL_TZ = datetime.now().astimezone().tzinfo
 
 LockRequest = namedtuple("LockRequest", ["priority", "request_timestamp", "lock_type", "client"])
 LockHold = namedtuple("LockHold", ["lock_type", "client", "acquire_timestamp"])
@@ -12,24 +15,100 @@ class LockManager(object):
 	LOCK_EXCLUSIVE = 1
 	LOCK_SHARED = 2
 	
-	def __init__(self, wakeup_interval=1):
+	def __init__(self, wakeup_interval=None):
+		"""
+		:param wakeup_interval: deprecated and ignored, waiters are woken as soon as the lock changes instead of polling
+		"""
+		if wakeup_interval is not None:
+			warnings.warn("LockManager wakeup_interval is deprecated and ignored", DeprecationWarning, stacklevel=2)
 		self.locks = dict()
 		self.holders = dict()
+		# per lock index of client -> queued LockRequest, kept in step with <locks>
+		self.client_requests = dict()
 		self.mutex = Lock()
-		self.wakeup_interval = wakeup_interval
+		# per lock Condition sharing <mutex>, signalled whenever that lock's request queue or holder list changes
+		# in a way that may let one of its waiters through
+		self.conditions = dict()
 	
 	def get_state(self):
+		"""
+		Snapshot of the request queues and holders of every lock, safe to iterate while other threads acquire and release
+		"""
+		with self.mutex:
+			return {k: tuple(v) for k, v in self.locks.items()}, {k: tuple(v) for k, v in self.holders.items()}
+	
+	def get_locks(self):
+		"""
+		Snapshot of the request queue of every lock
+		"""
+		with self.mutex:
+			return {k: tuple(v) for k, v in self.locks.items()}
+	
+	def get_holders(self):
+		"""
+		Snapshot of the holders of every lock
+		"""
+		with self.mutex:
+			return {k: tuple(v) for k, v in self.holders.items()}
+	
+	def get_lock(self, name):
+		"""
+		Snapshot of the request queue of lock <name>, None if there is no such lock
+		"""
+		with self.mutex:
+			requests = self.locks.get(name)
+			return tuple(requests) if requests is not None else None
+	
+	def get_lock_holders(self, name):
+		"""
+		Snapshot of the holders of lock <name>, None if it has never been held
+		"""
 		with self.mutex:
-			return self.locks, self.holders
+			holding = self.holders.get(name)
+			return tuple(holding) if holding is not None else None
 	
 	def client_removed(self, thelist, client):
-		counter = itertools.count()
-		newlist = [x for x in thelist if x.client != client or (x.client == client and next(counter) != 0)]
+		# drop only the first entry for <client>
+		newlist = []
+		removed = False
+		for x in thelist:
+			if not removed and x.client == client:
+				removed = True
+				continue
+			newlist.append(x)
 		return newlist
 	
-	def find_client_index(self, locks, client):
-		client_index = next((i for (i, tup) in enumerate(locks) if tup.client == client), None)
-		return client_index
+	def find_client_index(self, name, client):
+		request = self.client_requests.get(name, {}).get(client)
+		if request is None:
+			return None
+		# queues are sorted and a client only appears once, so the request is normally found by binary search
+		queue = self.locks[name]
+		client_index = bisect.bisect_left(queue, request)
+		if client_index < len(queue) and queue[client_index] is request:
+			return client_index
+		# an unorderable priority (e.g. NaN) breaks the sort order, fall back to a scan
+		return next((i for (i, x) in enumerate(queue) if x is request), None)
+	
+	def _condition(self, name):
+		condition = self.conditions.get(name)
+		if condition is None:
+			condition = self.conditions[name] = Condition(self.mutex)
+		return condition
+	
+	def _enqueue(self, name, request):
+		bisect.insort(self.locks.setdefault(name, []), request)
+		self.client_requests.setdefault(name, {})[request.client] = request
+	
+	def _dequeue(self, name, client):
+		"""
+		Remove <client>'s request from the queue of lock <name>, returning it or None if there is no such request
+		"""
+		client_index = self.find_client_index(name, client)
+		if client_index is None:
+			return None
+		del self.locks[name][client_index]
+		return self.client_requests[name].pop(client)
 	
 	def acquire(self, name, client, lock_type=LOCK_EXCLUSIVE, priority=2, timeout=1):
 		"""
@@ -43,41 +122,55 @@ class LockManager(object):
 		
 		:raises LockManagerTimeout: if <timeout> is exceeded
 		:raises LockManagerRepeatedAcquire: on double-acquire by the same client
+		:raises ValueError: on an unknown <lock_type> or a <timeout> that is not a number of seconds
 		"""
+		if lock_type not in (self.LOCK_EXCLUSIVE, self.LOCK_SHARED):
+			raise ValueError("unknown lock type: {0}".format(lock_type))
+		try:
+			timeout_seconds = float(timeout)
+		except (TypeError, ValueError):
+			raise ValueError("invalid timeout: {0!r}".format(timeout))
+		
 		with self.mutex:
-			if next((tup for tup in self.locks.get(name, []) if tup.client == client), None):
+			if client in self.client_requests.get(name, {}):
 				raise LockManagerRepeatedAcquire("acquire request on [{0}] by [{1}] already exists".format(name, client))
 			else:
 				# add the client to the queue in order of <priority> value
-				bisect.insort(self.locks.setdefault(name, []), LockRequest(priority, datetime.now().astimezone(), lock_type, client))
+				self._enqueue(name, LockRequest(priority, datetime.now(_LOCAL_TZ), lock_type, client))
 			
-		client_index = 0
-		start = time.time()
-		while True:
-			with self.mutex:
-				client_index = self.find_client_index(self.locks[name], client)
-				if lock_type == self.LOCK_EXCLUSIVE:
-					if not self.holders.get(name) and self.locks[name][0].client == client: #if no current holder and the front of the queue is the requesting client
-						break
-				elif lock_type == self.LOCK_SHARED:
-					counter =  itertools.count()
-					if not any(x.lock_type < lock_type for x in self.holders.get(name, [])) and not [x for x in self.locks[name] if x.lock_type < lock_type or (x.client == client and next(counter) !=0 )]: # no lower value locks held or preceded by in the request queue
-						break
-				else:
-					raise ValueError("unknown lock type: {0}".format(lock_type))
-			time.sleep(self.wakeup_interval)
-			if time.time() - start >= timeout:
-				# dequeue the client
-				with self.mutex:
-					requests = self.locks.get(name)
-					self.locks[name] = self.client_removed(requests, client)
-				raise LockManagerTimeout("{0} request on lock {1} exceeded timeout of {2}s".format(client, name, timeout))
-		
-		with self.mutex:
-			bisect.insort(self.holders.setdefault(name, []), LockHold(lock_type, client, datetime.now().astimezone()))
-		
-		# return the changed (if any) LockRequest object
-		return self.locks[name][client_index]
+			# the queue list is only ever modified in place so it can be bound once, holder lists are replaced on release
+			queue = self.locks[name]
+			condition = self._condition(name)
+			try:
+				deadline = time.monotonic() + timeout_seconds
+				while not self._can_grant(queue, self.holders.get(name), client, lock_type):
+					remaining = deadline - time.monotonic()
+					if remaining <= 0:
+						raise LockManagerTimeout("{0} request on lock {1} exceeded timeout of {2}s".format(client, name, timeout))
+					# Condition.wait rejects timeouts beyond TIMEOUT_MAX, a longer wait just loops
+					condition.wait(min(remaining, TIMEOUT_MAX))
+			except BaseException:
+				# never leave the request queued on timeout or error, dequeuing may also unblock other waiters
+				self._dequeue(name, client)
+				condition.notify_all()
+				raise
+			
+			bisect.insort(self.holders.setdefault(name, []), LockHold(lock_type, client, datetime.now(_LOCAL_TZ)))
+			
+			# return the changed (if any) LockRequest object
+			return self.client_requests[name][client]
+	
+	def _can_grant(self, queue, holding, client, lock_type):
+		"""
+		Whether <client> may take its <lock_type> lock given the lock's request <queue> and current <holding> list (or None),
+		must be called with the mutex held
+		"""
+		if lock_type == self.LOCK_EXCLUSIVE:
+			#if no current holder and the front of the queue is the requesting client
+			return not holding and queue[0].client == client
+		else:
+			# no lower value locks held or waiting in the request queue (a client is only ever queued once per lock)
+			return not (holding and any(x.lock_type < lock_type for x in holding)) and not any(x.lock_type < lock_type for x in queue)
 	
 	def release(self, lockname, client):
 		"""
@@ -97,13 +190,11 @@ class LockManager(object):
 				holding2 = self.client_removed(holding, client)
 				if len(holding) != len(holding2):
 					self.holders[lockname] = holding2
+					self._condition(lockname).notify_all()
 				else:
 					raise LockManagerNotFound("client [{0}] cannot release lock [{1}] as it is not holding it".format(client, lockname))
 				
-				requests2 = self.client_removed(requests, client)
-				if len(requests) != len(requests2):
-					self.locks[lockname] = requests2
-				else:
+				if self._dequeue(lockname, client) is None:
 					raise LockManagerNotFound("no client [{0}] against lock [{1}] found".format(client, lockname))
 			else:
 				raise LockManagerNotFound("no lock of name [{0}] found".format(lockname))
@@ -117,14 +208,13 @@ class LockManager(object):
 		with self.mutex:
 			requests = self.locks.get(name)
 			if requests:
-				client_index = next((i for (i, tup) in enumerate(requests) if tup.client == client), None)
-				if client_index:
-					old_request = requests[client_index]
+				old_request = self._dequeue(name, client)
+				if old_request is not None:
 					old_priority = old_request.priority
-					new_request = LockRequest(new_priority, datetime.now().astimezone(), old_request.lock_type, old_request.client)
+					new_request = LockRequest(new_priority, datetime.now(_LOCAL_TZ), old_request.lock_type, old_request.client)
 					
-					del requests[client_index]
-					bisect.insort(self.locks.setdefault(name, []), new_request)
+					self._enqueue(name, new_request)
+					self._condition(name).notify_all()
 					return old_priority
 				else:
 					raise LockManagerNotFound("no client of name [{0}] found".format(client))
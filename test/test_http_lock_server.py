@@ -1,35 +1,40 @@
 #!/usr/bin/env python3
 
+import base64
 from datetime import datetime
 from functools import partial
 from http import HTTPStatus
+import http.client
 import http.server
 import json
 import os
 import os.path
+import socket
 from threading import Event
+import time
 from urllib.request import HTTPError, Request, urlopen
 import unittest
 from unittest.mock import patch
 
-from http_lock_server import LockHttpHandler
+from http_lock_server import LockHttpHandler, PooledHTTPServer, basic_authorization
 from lock_manager import LockManager, LockManagerRepeatedAcquire, LockRequest, LockHold
 from .threading_helpers import PropagatingThread
 
-class HTTPLockServerTest(unittest.TestCase):
+class HTTPLockServerTestCase(unittest.TestCase):
 	
 	DEFAULT_TIMESTAMP = datetime.now().astimezone()
+	AUTHENTICATION = None
+	WORKERS = 32
 	
 	def setUp(self):
 		server_ready = Event()
 		self.stop_server = Event()
 		
 		self.lockm = LockManager()
-		lock_handler = partial(LockHttpHandler, self.lockm, None)
-		test_http_server = partial(DisposableThreadingHttpServer, server_ready, self.stop_server)
+		test_http_server = partial(DisposableThreadingHttpServer, server_ready, self.stop_server, self.lockm, self.AUTHENTICATION, workers=self.WORKERS)
 		self.port = os.environ.get("TEST_PORT", 8000)
 		self.ROOT_URL = "http://localhost:" + str(self.port)
-		self.server_thread = PropagatingThread(target=http.server.test, daemon=True, kwargs={"HandlerClass": lock_handler, "ServerClass": test_http_server, "port": self.port})
+		self.server_thread = PropagatingThread(target=http.server.test, daemon=True, kwargs={"HandlerClass": LockHttpHandler, "ServerClass": test_http_server, "port": self.port})
 		self.server_thread.start()
 		
 		# wait until the server_thread has finished starting
@@ -42,6 +47,8 @@ class HTTPLockServerTest(unittest.TestCase):
 			self.server_thread.join()
 		except:
 			pass
+
+class HTTPLockServerTest(HTTPLockServerTestCase):
 	
 	def test_GET(self):
 		self.lockm.locks = {
@@ -51,6 +58,45 @@ class HTTPLockServerTest(unittest.TestCase):
 			response = f.read().decode("utf-8")
 			self.assertEqual(json.loads(response), {"lock1": [{"priority": 1, "request_timestamp": self.DEFAULT_TIMESTAMP.isoformat(), "lock_type": LockManager.LOCK_EXCLUSIVE, "client": "client1"}]})
 	
+	def test_GET_multiple(self):
+		self.lockm.locks = {
+			"lock1": [LockRequest(1, self.DEFAULT_TIMESTAMP, LockManager.LOCK_EXCLUSIVE, "client1")],
+			"lock2": [],
+			"lock3": [
+				LockRequest(1, self.DEFAULT_TIMESTAMP, LockManager.LOCK_SHARED, "client1"),
+				LockRequest(2, self.DEFAULT_TIMESTAMP, LockManager.LOCK_SHARED, "client2")
+			]
+		}
+		with urlopen(self.ROOT_URL + "/locks") as f:
+			response = f.read().decode("utf-8")
+			self.assertEqual(
+				json.loads(response),
+				{
+					"lock1": [{"priority": 1, "request_timestamp": self.DEFAULT_TIMESTAMP.isoformat(), "lock_type": LockManager.LOCK_EXCLUSIVE, "client": "client1"}],
+					"lock2": [],
+					"lock3": [
+						{"priority": 1, "request_timestamp": self.DEFAULT_TIMESTAMP.isoformat(), "lock_type": LockManager.LOCK_SHARED, "client": "client1"},
+						{"priority": 2, "request_timestamp": self.DEFAULT_TIMESTAMP.isoformat(), "lock_type": LockManager.LOCK_SHARED, "client": "client2"}
+					]
+				}
+			)
+	
+	@patch("http_lock_server._lock_fmt")
+	def test_GET_error_while_streaming(self, mock):
+		mock.side_effect = [{"client": "client1"}, Exception()]
+		self.lockm.locks = {
+			"lock1": [LockRequest(1, self.DEFAULT_TIMESTAMP, LockManager.LOCK_EXCLUSIVE, "client1")],
+			"lock2": [LockRequest(1, self.DEFAULT_TIMESTAMP, LockManager.LOCK_EXCLUSIVE, "client2")]
+		}
+		with urlopen(self.ROOT_URL + "/locks") as f:
+			self.assertEqual(f.getcode(), HTTPStatus.OK.value)
+			# truncated after the last complete member, no second status line written into the body
+			response = f.read()
+			self.assertTrue(response.startswith(b'{"lock1":'))
+			self.assertNotIn(b"HTTP/", response)
+			with self.assertRaises(ValueError):
+				json.loads(response)
+	
 	def test_GET_single(self):
 		self.lockm.locks = {
 			"lock1": [LockRequest(1, self.DEFAULT_TIMESTAMP, LockManager.LOCK_EXCLUSIVE, "client1")]
@@ -59,6 +105,28 @@ class HTTPLockServerTest(unittest.TestCase):
 			response = f.read().decode("utf-8")
 			self.assertEqual(json.loads(response), [{"priority": 1, "request_timestamp": self.DEFAULT_TIMESTAMP.isoformat(), "lock_type": LockManager.LOCK_EXCLUSIVE, "client": "client1"}])
 	
+	def test_GET_single_trailing_slash(self):
+		self.lockm.locks = {
+			"lock1": [LockRequest(1, self.DEFAULT_TIMESTAMP, LockManager.LOCK_EXCLUSIVE, "client1")]
+		}
+		with urlopen(self.ROOT_URL + "/locks/lock1/") as f:
+			response = f.read().decode("utf-8")
+			self.assertEqual(json.loads(response), [{"priority": 1, "request_timestamp": self.DEFAULT_TIMESTAMP.isoformat(), "lock_type": LockManager.LOCK_EXCLUSIVE, "client": "client1"}])
+	
+	def test_GET_double_trailing_slash(self):
+		self.lockm.locks = {
+			"lock1": [LockRequest(1, self.DEFAULT_TIMESTAMP, LockManager.LOCK_EXCLUSIVE, "client1")]
+		}
+		# an empty lock name rather than the population of all locks
+		with self.assertRaises(HTTPError) as raised:
+			urlopen(self.ROOT_URL + "/locks//")
+		self.assertEqual(raised.exception.getcode(), HTTPStatus.NOT_FOUND.value)
+	
+	def test_DELETE_empty_client(self):
+		with self.assertRaises(HTTPError) as raised:
+			urlopen(Request(self.ROOT_URL + "/locks/lock1/", method="DELETE"))
+		self.assertEqual(raised.exception.getcode(), HTTPStatus.BAD_REQUEST.value)
+	
 	def test_GET_holders(self):
 		self.lockm.holders = {
 			"lock1": [
@@ -101,7 +169,7 @@ class HTTPLockServerTest(unittest.TestCase):
 			urlopen(self.ROOT_URL + "/locks/notfound")
 		self.assertEqual(raised.exception.getcode(), HTTPStatus.NOT_FOUND.value)
 	
-	@patch.object(LockManager, "get_state")
+	@patch.object(LockManager, "get_locks")
 	def test_GET_500(self, mock):
 		mock.side_effect = Exception()
 		with self.assertRaises(HTTPError) as raised:
@@ -124,13 +192,61 @@ class HTTPLockServerTest(unittest.TestCase):
 			urlopen(Request(self.ROOT_URL + "/locks/lock1/client1", data='{}'.encode("utf-8"), method="PUT"))
 		self.assertEqual(raised.exception.getcode(), HTTPStatus.BAD_REQUEST.value)
 	
+	@patch.object(LockManager, "acquire")
+	def test_PUT_413(self, mock):
+		with self.assertRaises(HTTPError) as raised:
+			urlopen(Request(self.ROOT_URL + "/locks/lock1/client1", data='{"priority":1, "type":"exclusive"}'.encode("utf-8"), headers={"Content-Length": "1000000"}, method="PUT"))
+		self.assertEqual(raised.exception.getcode(), HTTPStatus.REQUEST_ENTITY_TOO_LARGE.value)
+		mock.assert_not_called()
+	
 	@patch.object(LockManager, "acquire")
 	def test_PUT_500(self, mock):
 		mock.side_effect = Exception()
 		with self.assertRaises(HTTPError) as raised:
-			urlopen(Request(self.ROOT_URL + "/locks/lock1/client1", method="PUT"))
+			urlopen(Request(self.ROOT_URL + "/locks/lock1/client1", data='{"priority":1, "type":"exclusive"}'.encode("utf-8"), method="PUT"))
 		self.assertEqual(raised.exception.getcode(), HTTPStatus.INTERNAL_SERVER_ERROR.value)
 	
+	def test_PUT_invalid_timeout(self):
+		with self.assertRaises(HTTPError) as raised:
+			urlopen(Request(self.ROOT_URL + "/locks/lock1/client1", data='{"priority":1, "type":"exclusive", "timeout":null}'.encode("utf-8"), method="PUT"))
+		self.assertEqual(raised.exception.getcode(), HTTPStatus.BAD_REQUEST.value)
+		
+		# the rejected request does not block later acquirers
+		with urlopen(Request(self.ROOT_URL + "/locks/lock1/client2", data='{"priority":1, "type":"exclusive", "timeout":1}'.encode("utf-8"), method="PUT")) as f:
+			self.assertEqual(f.getcode(), HTTPStatus.CREATED.value)
+	
+	def test_PUT_invalid_priority(self):
+		for priority in ("NaN", "Infinity", '"1"', "true"):
+			with self.assertRaises(HTTPError) as raised:
+				urlopen(Request(self.ROOT_URL + "/locks/lock1/client1", data='{{"priority":{0}, "type":"exclusive"}}'.format(priority).encode("utf-8"), method="PUT"))
+			self.assertEqual(raised.exception.getcode(), HTTPStatus.BAD_REQUEST.value)
+		self.assertEqual(self.lockm.get_state()[0], {})
+	
+	def test_PUT_invalid_json(self):
+		with self.assertRaises(HTTPError) as raised:
+			urlopen(Request(self.ROOT_URL + "/locks/lock1/client1", method="PUT"))
+		self.assertEqual(raised.exception.getcode(), HTTPStatus.BAD_REQUEST.value)
+	
+	def test_PUT_negative_content_length(self):
+		with self.assertRaises(HTTPError) as raised:
+			urlopen(Request(self.ROOT_URL + "/locks/lock1/client1", data=b"{}", headers={"Content-Length": "-1"}, method="PUT"))
+		self.assertEqual(raised.exception.getcode(), HTTPStatus.BAD_REQUEST.value)
+	
+	def test_PUT_non_numeric_content_length(self):
+		with self.assertRaises(HTTPError) as raised:
+			urlopen(Request(self.ROOT_URL + "/locks/lock1/client1", data=b"{}", headers={"Content-Length": "abc"}, method="PUT"))
+		self.assertEqual(raised.exception.getcode(), HTTPStatus.BAD_REQUEST.value)
+	
+	def test_PUT_411(self):
+		# urllib always sends a Content-Length for PUT, so build the request by hand
+		conn = http.client.HTTPConnection("localhost", self.port)
+		try:
+			conn.putrequest("PUT", "/locks/lock1/client1")
+			conn.endheaders()
+			self.assertEqual(conn.getresponse().status, HTTPStatus.LENGTH_REQUIRED.value)
+		finally:
+			conn.close()
+	
 	@patch.object(LockManager, "release")
 	def test_DELETE(self, _):
 		with urlopen(Request(self.ROOT_URL + "/locks/lock1/client1", data='{"priority":1, "type":"exclusive"}'.encode("utf-8"), method="DELETE")) as f:
@@ -141,14 +257,89 @@ class HTTPLockServerTest(unittest.TestCase):
 		with urlopen(Request(self.ROOT_URL + "/locks/lock1/client1", data='{"priority":0}'.encode("utf-8"), method="PATCH")) as f:
 			self.assertEqual(f.getcode(), HTTPStatus.OK.value)
 	
+	@patch.object(LockManager, "modify_priority", return_value=1)
+	def test_PATCH_invalid_priority(self, mock):
+		with self.assertRaises(HTTPError) as raised:
+			urlopen(Request(self.ROOT_URL + "/locks/lock1/client1", data='{"priority":NaN}'.encode("utf-8"), method="PATCH"))
+		self.assertEqual(raised.exception.getcode(), HTTPStatus.BAD_REQUEST.value)
+		mock.assert_not_called()
+	
+	@patch.object(LockManager, "modify_priority", return_value=1)
+	def test_PATCH_413(self, mock):
+		with self.assertRaises(HTTPError) as raised:
+			urlopen(Request(self.ROOT_URL + "/locks/lock1/client1", data='{"priority":0}'.encode("utf-8"), headers={"Content-Length": "1000000"}, method="PATCH"))
+		self.assertEqual(raised.exception.getcode(), HTTPStatus.REQUEST_ENTITY_TOO_LARGE.value)
+		mock.assert_not_called()
+	
 	def test_404_generic(self):
 		with self.assertRaises(HTTPError) as raised:
 			urlopen(self.ROOT_URL + "/notfound")
 		self.assertEqual(raised.exception.getcode(), HTTPStatus.NOT_FOUND.value)
 
-class DisposableThreadingHttpServer(http.server.ThreadingHTTPServer):
-	def __init__(self, server_ready, stop_server, *args, **kwargs):
+class HTTPLockServerAuthTest(HTTPLockServerTestCase):
+	
+	AUTHENTICATION = "user:pass"
+	
+	def test_401(self):
+		with self.assertRaises(HTTPError) as raised:
+			urlopen(self.ROOT_URL + "/locks")
+		self.assertEqual(raised.exception.getcode(), HTTPStatus.UNAUTHORIZED.value)
+	
+	def test_401_wrong_credentials(self):
+		with self.assertRaises(HTTPError) as raised:
+			urlopen(Request(self.ROOT_URL + "/locks", headers={"Authorization": "Basic " + base64.b64encode(b"user:wrong").decode("ascii")}))
+		self.assertEqual(raised.exception.getcode(), HTTPStatus.UNAUTHORIZED.value)
+	
+	def test_authenticated(self):
+		with urlopen(Request(self.ROOT_URL + "/locks", headers={"Authorization": "Basic " + base64.b64encode(b"user:pass").decode("ascii")})) as f:
+			self.assertEqual(f.getcode(), HTTPStatus.OK.value)
+
+class HTTPLockServerPoolTest(HTTPLockServerTestCase):
+	
+	WORKERS = 2
+	
+	def test_DELETE_with_waiting_PUTs(self):
+		"""Test a release is handled while every pooled worker is occupied by a PUT waiting on the lock"""
+		self.lockm.acquire("lock1", "holder")
+		
+		def waiter(client):
+			def put():
+				with urlopen(Request(self.ROOT_URL + "/locks/lock1/" + client, data='{"priority":1, "type":"shared", "timeout":5}'.encode("utf-8"), method="PUT")) as f:
+					return f.getcode()
+			return PropagatingThread(target=put)
+		waiters = [waiter("client1"), waiter("client2")]
+		for t in waiters:
+			t.start()
+		
+		# wait for both PUT requests to be queued
+		deadline = time.monotonic() + 5
+		while len(self.lockm.get_state()[0]["lock1"]) < 3:
+			self.assertLess(time.monotonic(), deadline)
+			time.sleep(0.01)
+		
+		start = time.monotonic()
+		with urlopen(Request(self.ROOT_URL + "/locks/lock1/holder", method="DELETE")) as f:
+			self.assertEqual(f.getcode(), HTTPStatus.OK.value)
+		self.assertLess(time.monotonic() - start, 1)
+		
+		for t in waiters:
+			self.assertEqual(t.join(5), HTTPStatus.CREATED.value)
+	
+	def test_idle_connections(self):
+		"""Test connections that never send a request do not stop others being served"""
+		idle = [socket.create_connection(("localhost", self.port)) for _ in range(self.WORKERS)]
+		try:
+			with urlopen(self.ROOT_URL + "/locks", timeout=5) as f:
+				self.assertEqual(f.getcode(), HTTPStatus.OK.value)
+		finally:
+			for sock in idle:
+				sock.close()
+
+class DisposableThreadingHttpServer(PooledHTTPServer):
+	def __init__(self, server_ready, stop_server, lockmanager, authentication, *args, **kwargs):
 		super(DisposableThreadingHttpServer, self).__init__(*args, **kwargs)
+		self.lockmanager = lockmanager
+		self.expected_authorization = basic_authorization(authentication)
 		self.server_ready = server_ready
 		self.stop_server = stop_server
 	
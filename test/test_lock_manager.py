@@ -248,7 +248,107 @@ class LockManagerTest(unittest.TestCase):
 		def client2():
 			event1.wait()
 			with self.assertRaises(LockManagerTimeout):
-				self.lockm.acquire("lock1", "client2")
+				self.lockm.acquire("lock1", "client2", timeout=3)
 			event2.set()
 		
 		self.joinThreads([client1, client2])
+	
+	def test_release_wakes_waiter(self):
+		"""Test a waiting client acquires as soon as the lock is released rather than on a polling interval"""
+		event1 = Event()
+		def client1():
+			self.lockm.acquire("lock1", "client1")
+			event1.set()
+			
+			while len(self.getLocks().get("lock1")) <= 1:
+				time.sleep(0.01)
+			self.lockm.release("lock1", "client1")
+		
+		def client2():
+			event1.wait()
+			start = time.monotonic()
+			self.lockm.acquire("lock1", "client2", timeout=5)
+			self.assertLess(time.monotonic() - start, 1)
+			self.lockm.release("lock1", "client2")
+		
+		self.joinThreads([client1, client2])
+	
+	def test_priority_change_front(self):
+		"""Test the priority of the request at the front of the queue can be changed"""
+		self.lockm.acquire("lock1", "client1", priority=1)
+		self.assertEqual(self.lockm.modify_priority("lock1", "client1", new_priority=5), 1)
+		self.assertLocks({"lock1": [(5, "client1")]})
+		self.lockm.release("lock1", "client1")
+	
+	def test_state_snapshot(self):
+		"""Test the state returned by get_state is not changed by later lock operations"""
+		self.lockm.acquire("lock1", "client1")
+		locks, holders = self.lockm.get_state()
+		self.lockm.release("lock1", "client1")
+		self.lockm.acquire("lock2", "client1")
+		self.assertEqual([x.client for x in locks["lock1"]], ["client1"])
+		self.assertEqual([x.client for x in holders["lock1"]], ["client1"])
+		self.assertNotIn("lock2", locks)
+	
+	def test_invalid_timeout(self):
+		"""Test an acquire with a non-numeric timeout is rejected without leaving its request queued"""
+		with self.assertRaises(ValueError):
+			self.lockm.acquire("lock1", "client1", timeout=None)
+		self.assertEqual(self.getLocks().get("lock1", ()), ())
+		
+		# a numeric string is converted
+		self.lockm.acquire("lock1", "client1", timeout="5")
+		self.lockm.release("lock1", "client1")
+		self.assertLocks({"lock1": []})
+	
+	def test_wakeup_interval_deprecated(self):
+		"""Test the old wakeup_interval argument is still accepted"""
+		with self.assertWarns(DeprecationWarning):
+			lockm = LockManager(1)
+		lockm.acquire("lock1", "client1")
+		lockm.release("lock1", "client1")
+	
+	def test_nan_priority(self):
+		"""Test an unorderable priority does not make a timed out request dequeue another client's request"""
+		self.lockm.acquire("lock1", "client1", priority=float("nan"))
+		with self.assertRaises(LockManagerTimeout):
+			self.lockm.acquire("lock1", "client2", priority=1, timeout=0.1)
+		self.assertEqual([x.client for x in self.getLocks()["lock1"]], ["client1"])
+		self.assertEqual(list(self.lockm.client_requests["lock1"]), ["client1"])
+		
+		self.lockm.release("lock1", "client1")
+		self.lockm.acquire("lock1", "client2", priority=1)
+		self.lockm.release("lock1", "client2")
+		self.assertLocks({"lock1": []})
+	
+	def test_huge_timeout(self):
+		"""Test a timeout beyond what Condition.wait accepts still waits for the lock"""
+		self.lockm.acquire("lock1", "client1")
+		def client2():
+			self.lockm.acquire("lock1", "client2", timeout=2**40)
+			self.lockm.release("lock1", "client2")
+		
+		def client3():
+			self.lockm.acquire("lock1", "client3", lock_type=LockManager.LOCK_SHARED, timeout="inf")
+			self.lockm.release("lock1", "client3")
+		
+		def client1():
+			deadline = time.monotonic() + self.TESTCASE_TIMEOUT
+			while len(self.getLocks().get("lock1")) <= 2 and time.monotonic() < deadline:
+				time.sleep(0.01)
+			self.lockm.release("lock1", "client1")
+		
+		self.joinThreads([client1, client2, client3])
+		self.assertLocks({"lock1": []})
+	
+	def test_narrow_snapshots(self):
+		"""Test the per mapping and per lock accessors match get_state"""
+		self.lockm.acquire("lock1", "client1")
+		self.lockm.acquire("lock2", "client2", lock_type=LockManager.LOCK_SHARED)
+		locks, holders = self.lockm.get_state()
+		self.assertEqual(self.lockm.get_locks(), locks)
+		self.assertEqual(self.lockm.get_holders(), holders)
+		self.assertEqual(self.lockm.get_lock("lock1"), locks["lock1"])
+		self.assertEqual(self.lockm.get_lock_holders("lock2"), holders["lock2"])
+		self.assertIsNone(self.lockm.get_lock("notfound"))
+		self.assertIsNone(self.lockm.get_lock_holders("notfound"))